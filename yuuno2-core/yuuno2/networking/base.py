@@ -32,6 +32,7 @@ class Message(NamedTuple):
 
 
 class MessageInputStream(Resource, ABC):
+    __slots__ = ()
 
     @abstractmethod
     async def read(self) -> Optional[Message]:
@@ -39,6 +40,7 @@ class MessageInputStream(Resource, ABC):
 
 
 class MessageOutputStream(Resource, ABC):
+    __slots__ = ()
 
     @abstractmethod
     async def write(self, message: Message) -> NoReturn:
@@ -50,6 +52,8 @@ class MessageOutputStream(Resource, ABC):
 
 
 class Connection(Resource):
+    __slots__ = ('input', 'output')
+
     input: MessageInputStream
     output: MessageOutputStream
 
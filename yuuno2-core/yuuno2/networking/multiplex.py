@@ -16,34 +16,84 @@
 #
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-from asyncio import Lock, Event
-from typing import Optional, MutableMapping, NoReturn
+from asyncio import Event, Task, Future, CancelledError
+from asyncio import get_running_loop
+from collections import deque, OrderedDict
+from sys import intern
+from typing import Optional, Dict, NoReturn, Deque, List, Any, Tuple
 
-from yuuno2.resource_manager import register, Resource
+from yuuno2.asyncutils import suppress_cancel
+from yuuno2.resource_manager import register, on_release, Resource
 
-from yuuno2.networking.base import Connection, Message, MessageOutputStream, MessageInputStream
+from yuuno2.networking.base import Connection, Message, JSON, MessageOutputStream, MessageInputStream
 from yuuno2.networking.reader import ReaderTask
-from yuuno2.networking.pipe import pipe
+from yuuno2.networking.pipe import PipePool, PipeData
+
+
+#: How many inbound messages may wait for dispatch before the reader is paused.
+INGRESS_RING_SIZE = 256
+
+#: How many outgoing messages may be queued before writers have to wait.
+EGRESS_QUEUE_SIZE = 256
+
+#: How many close- and illegal-replies are kept for reuse.
+REPLY_CACHE_SIZE = 256
+
+# The lower bits of a channel id select its slot in streams_by_id.
+# The upper bits count how often the slot has been reused.
+_ID_SLOT_BITS = 16
+_ID_SLOT_MASK = (1 << _ID_SLOT_BITS) - 1
+_ID_GENERATION = 1 << _ID_SLOT_BITS
+
+_MISSING = object()
+
+# Message is a NamedTuple. Its generated __new__ is a Python function,
+# so per-message construction on the hot paths calls the tuple constructor directly.
+_new_message = tuple.__new__
+
+
+def _mark_released(resource: Resource) -> NoReturn:
+    # Called by the resource manager as soon as the resource stops being acquired.
+    resource._acquired = False
+
+
+def _check_acquired_fast(resource: Resource) -> NoReturn:
+    """
+    Synchronous replacement for Resource.ensure_acquired on the hot paths.
+
+    It only reads the cached _acquired flag. The check for a deferred release
+    after the parent died is skipped on purpose, as it needs an await and the
+    lookup of the resource state per call. Such a resource is still caught by
+    the ensure_acquired of the pipes and connections it uses.
+    """
+    if not resource._acquired:
+        raise AssertionError("Resource not acquired.")
 
 
 class ChannelOutputStream(MessageOutputStream):
+    __slots__ = ('channel', '_envelope')
 
     def __init__(self, channel: 'Channel'):
         self.channel = channel
+        # Everything but the payload is the same for every message of the channel.
+        if channel.id is None:
+            self._envelope = {'target': channel.name, 'type': 'message'}
+        else:
+            self._envelope = {'target': channel.name, 'sid': channel.id, 'type': 'message'}
         register(self.channel, self)
 
     async def write(self, message: Message) -> NoReturn:
-        await self.channel.multiplexer.write(
-            Message({'target': self.channel.name, 'type': 'message', 'payload': message.values}, message.blobs)
-        )
+        values = self._envelope.copy()
+        values['payload'] = message.values
+        await self.channel.multiplexer.write(_new_message(Message, (values, message.blobs)))
 
     async def close(self) -> NoReturn:
-        self.channel.multiplexer.streams.pop(self.channel.name, None)
+        self.channel._unregister()
         if self.channel.ingress is not None and self.channel.ingress.output is not None:
             await self.channel.ingress.close()
 
-        if self.channel.multiplexer.acquired:
-            await self.channel.multiplexer.write(Message({'target': self.channel.name, 'type': 'close'}))
+        if self.channel.multiplexer._acquired:
+            await self.channel.multiplexer.write(self.channel._close_msg)
 
     async def _acquire(self) -> NoReturn:
         pass
@@ -53,25 +103,50 @@ class ChannelOutputStream(MessageOutputStream):
 
 
 class Channel(Connection):
+    __slots__ = (
+        '_acquired', '_closed', '_removed', 'name', 'multiplexer', 'id', 'remote_id',
+        'ingress', 'egress', '_pipe', '_close_msg', '_connection_cache'
+    )
 
     def __init__(self, multiplexer: 'Multiplexer', name: str):
+        self._acquired = False
         self._closed = False
+        self._removed = False
 
         self.name = name
         self.multiplexer = multiplexer
 
+        # Only used if the multiplexer addresses channels by id.
+        # The remote id is learned from the first message the peer sends us.
+        self.id: Optional[int] = None
+        self.remote_id: Optional[int] = None
+
         self.ingress: Optional[Connection] = None
         self.egress: Optional[ChannelOutputStream] = None
+        self._pipe: Optional[PipeData] = None
+        self._close_msg: Optional[Message] = None
         self._connection_cache = None
         super().__init__(None, None)
 
+    def _set_remote_id(self, remote_id: int) -> NoReturn:
+        # Both sides know the ids now. The name is not sent anymore.
+        self.remote_id = remote_id
+        self._close_msg = Message({'sid': self.id, 'tid': remote_id, 'type': 'close'})
+        if self.egress is not None:
+            self.egress._envelope = {'sid': self.id, 'tid': remote_id, 'type': 'message'}
+
+    def _unregister(self) -> NoReturn:
+        # A failed _acquire might have left the name to another channel.
+        if not self._removed and self.multiplexer.streams.get(self.name) is self:
+            self.multiplexer._remove_channel(self)
+
     async def deliver(self, message: Optional[Message]) -> NoReturn:
         if message is None:
             self._closed = True
-            if not self.acquired:
+            if not self._acquired:
                 return
 
-        await self.ensure_acquired()
+        _check_acquired_fast(self)
         await self.ingress.write(message)
 
     @property
@@ -89,46 +164,56 @@ class Channel(Connection):
     def output(self, value): pass
 
     async def _acquire(self) -> NoReturn:
+        self._acquired = True
+        on_release(self, _mark_released)
+
         if self.name in self.multiplexer.streams:
             raise RuntimeError("Stream already registered.")
 
         self.multiplexer.streams[self.name] = self
-
-        self.ingress: Connection = Connection(*pipe())
+        if self.multiplexer.channel_ids:
+            # Announce our id to the peer until it tells us its own.
+            self.id = self.multiplexer._allocate_id(self)
+            self._close_msg = Message({'target': self.name, 'sid': self.id, 'type': 'close'})
+        else:
+            self._close_msg = Message({'target': self.name, 'type': 'close'})
+
+        pipe_r, pipe_w = self.multiplexer._pipe_pool.pipe()
+        self._pipe = pipe_r.pipe
+        self.ingress = Connection(pipe_r, pipe_w)
         await self.ingress.acquire()
         register(self, self.ingress)
 
-        self.egress: ChannelOutputStream = ChannelOutputStream(self)
+        self.egress = ChannelOutputStream(self)
         await self.egress.acquire()
         register(self, self.egress)
 
     async def _release(self) -> NoReturn:
 
-        if not self._closed and self.multiplexer.acquired:
-            await self.multiplexer.write(Message({
-                "target": self.name, "type": "close"
-            }))
+        if not self._closed and self._close_msg is not None and self.multiplexer._acquired:
+            await self.multiplexer.write(self._close_msg)
         self._closed = True
-
-        self.multiplexer.streams.pop(self.name, None)
-
-        await self.ingress.release(force=False)
-        await self.egress.release(force=False)
-        self.ingress = None
-        self.egress = None
+        self._unregister()
+
+        # _acquire might have failed before the streams were created.
+        if self.ingress is not None:
+            await self.ingress.release(force=False)
+        if self.egress is not None:
+            await self.egress.release(force=False)
+        if self._pipe is not None:
+            self.multiplexer._pipe_pool.recycle(self._pipe)
+        self._pipe = None
         self.multiplexer = None
         self._connection_cache = None
 
-    def _ensure_open(self):
+    async def read(self) -> Optional[Message]:
         if self._closed:
             raise ConnectionResetError
-
-    async def read(self) -> Optional[Message]:
-        self._ensure_open()
         return (await self.ingress.input.read())
 
     async def write(self, message: Message):
-        self._ensure_open()
+        if self._closed:
+            raise ConnectionResetError
         return (await self.egress.write(message))
 
     async def close(self):
@@ -142,64 +227,382 @@ class Channel(Connection):
 
 
 class Multiplexer(Resource):
-
-    def __init__(self, parent: Connection):
-        self.streams: MutableMapping[str, Channel] = {}
-        self._w_lock = Lock()
-        self._closed = Event()
-        self._shutdown = Event()
+    __slots__ = (
+        '_acquired', 'channel_ids', 'streams', 'streams_by_id', '_free_ids', '_pipe_pool',
+        '_writing', '_waiters', '_writer_task',
+        '_out_pending', '_out_event', '_out_blocked', '_out_error', '_out_busy', '_out_flushed',
+        '_ingress_ring', '_ingress_event', '_ingress_space', '_dispatch_task',
+        '_reply_cache',
+        '_closed_fut', '_shutdown_fut', 'parent'
+    )
+
+    def __init__(self, parent: Connection, *, channel_ids: bool = False):
+        """
+        :param parent:       The connection to multiplex.
+        :param channel_ids:  Address channels by integer ids instead of their names once
+                             both sides know them. Peers that do not support ids keep
+                             using the names, so this can be enabled on one side only.
+        """
+        self._acquired = False
+        self.channel_ids = channel_ids
+        self.streams: Dict[str, Channel] = {}
+        self.streams_by_id: List[Optional[Channel]] = []
+        self._free_ids: Deque[int] = deque()
+        self._pipe_pool = PipePool()
+        self._writing: bool = False
+        self._waiters: Deque[Future] = deque()
+        self._out_pending: List[Message] = []
+        self._out_event = Event()
+        self._out_blocked: Deque[Future] = deque()
+        self._out_error: Optional[Exception] = None
+        self._out_busy: bool = False
+        self._out_flushed: Optional[Future] = None
+        self._writer_task: Optional[Task] = None
+        self._ingress_ring: Deque[Optional[Message]] = deque()
+        self._ingress_event = Event()
+        self._ingress_space = Event()
+        self._dispatch_task: Optional[Task] = None
+        self._reply_cache: 'OrderedDict[Tuple[str, str], Message]' = OrderedDict()
+        self._closed_fut: Optional[Future] = None
+        self._shutdown_fut: Optional[Future] = None
         self.parent = parent
 
+    async def _enqueue(self, raw: Optional[Message]) -> NoReturn:
+        ring = self._ingress_ring
+        while len(ring) >= INGRESS_RING_SIZE:
+            self._ingress_space.clear()
+            await self._ingress_space.wait()
+
+        ring.append(raw)
+        if not self._ingress_event.is_set():
+            self._ingress_event.set()
+
+    async def _dispatch_loop(self) -> NoReturn:
+        # Bind everything used per message once.
+        ring = self._ingress_ring
+        popleft = ring.popleft
+        event = self._ingress_event
+        space = self._ingress_space
+        delivered = self._delivered
+        loop = get_running_loop()
+
+        while True:
+            await event.wait()
+            event.clear()
+
+            while ring:
+                raw = popleft()
+                if not space.is_set():
+                    space.set()
+
+                # A single broken message must not stop the dispatcher.
+                # Otherwise the reader blocks as soon as the ring is full.
+                try:
+                    await delivered(raw)
+                except CancelledError:
+                    raise
+                except Exception as e:
+                    loop.call_exception_handler({
+                        'message': 'Failed to dispatch an inbound message.',
+                        'exception': e,
+                    })
+
+                if raw is None:
+                    return
+
     async def _delivered(self, raw: Optional[Message]) -> None:
-        if not self.acquired:
+        if not self._acquired:
             return
 
         if raw is None:
-            self._shutdown.set()
+            if not self._shutdown_fut.done():
+                self._shutdown_fut.set_result(None)
             return
 
         msg, buffers = raw
 
-        connection = msg.get("target", "")
-        type = msg.get("type", "message")
+        try:
+            type = msg["type"]
+            payload = msg["payload"]
+        except KeyError:
+            # Close-messages carry no payload and the type may be omitted.
+            type = msg.get("type", "message")
+            payload = msg.get("payload", _MISSING)
+
+        tid = msg.get("tid") if self.channel_ids else None
+        if tid is None:
+            connection = msg.get("target", "")
+            reader = self.streams.get(connection)
+        else:
+            # Messages addressed by id carry no name. Replies go to the id of the sender.
+            connection = msg.get("sid", "")
+            reader = self._find_channel(tid)
+        # The type is chosen by the peer and might not even be hashable.
+        if isinstance(type, str):
+            handler = self._handlers.get(type, Multiplexer._on_illegal)
+        else:
+            handler = Multiplexer._on_illegal
+        await handler(self, reader, connection, payload, msg, buffers)
+
+    async def _on_close(self, reader: Optional[Channel], connection: str, payload: Any, msg: JSON, buffers: List[bytes]) -> None:
+        if reader is None:
+            return
+        self._remove_channel(reader)
+        await reader.deliver(None)
 
-        if type in ("close", "illegal"):
-            reader = self.streams.pop(connection, None)
-            if reader is None:
-                return
-            await reader.deliver(None)
+    async def _on_message(self, reader: Optional[Channel], connection: str, payload: Any, msg: JSON, buffers: List[bytes]) -> None:
+        if reader is None:
+            await self.write(self._reply(connection, "close"))
             return
 
-        if connection not in self.streams:
-            await self.write(Message({"target": connection, "type": "close", "payload": {}}))
+        if payload is _MISSING:
+            await self.write(self._reply(connection, "illegal"))
             return
 
-        if "payload" not in msg:
-            await self.write(Message({"target": connection, "type": "illegal", "payload": {}}))
+        if self.channel_ids:
+            sid = msg.get("sid")
+            if sid != reader.remote_id and isinstance(sid, int):
+                reader._set_remote_id(sid)
+
+        await reader.deliver(_new_message(Message, (payload, buffers)))
+
+    async def _on_illegal(self, reader: Optional[Channel], connection: str, payload: Any, msg: JSON, buffers: List[bytes]) -> None:
+        if reader is None:
+            await self.write(self._reply(connection, "close"))
             return
 
-        await self.streams[connection].deliver(Message(msg["payload"], buffers))
-        return
+        await self.write(self._reply(connection, "illegal"))
+
+    def _reply(self, connection: str, type: str) -> Message:
+        """
+        Returns the reply rejecting a message sent to the given target.
+
+        Replies are kept in a bounded LRU-cache so a peer repeatedly sending
+        to unknown targets does not cause a new message for every reply.
+        """
+        cache = self._reply_cache
+        key = (connection, type)
+
+        reply = cache.get(key)
+        if reply is None:
+            if isinstance(connection, int):
+                reply = Message({"tid": connection, "type": type, "payload": {}})
+            else:
+                reply = Message({"target": connection, "type": type, "payload": {}})
+            cache[key] = reply
+            if len(cache) > REPLY_CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+
+        return reply
+
+    #: Maps the type of an inbound message to its handler.
+    _handlers = {
+        "close": _on_close,
+        "illegal": _on_close,
+        "message": _on_message,
+    }
+
+    def _find_channel(self, cid: Any) -> Optional[Channel]:
+        # Ids are reused, so check the generation as well.
+        streams_by_id = self.streams_by_id
+        if not isinstance(cid, int) or cid < 0:
+            return None
+
+        slot = cid & _ID_SLOT_MASK
+        if slot >= len(streams_by_id):
+            return None
+
+        channel = streams_by_id[slot]
+        if channel is None or channel.id != cid:
+            return None
+        return channel
+
+    def _allocate_id(self, channel: Channel) -> int:
+        if self._free_ids:
+            # Messages still addressed to the previous channel in this slot are rejected.
+            cid = self._free_ids.popleft() + _ID_GENERATION
+            self.streams_by_id[cid & _ID_SLOT_MASK] = channel
+            return cid
+
+        cid = len(self.streams_by_id)
+        if cid > _ID_SLOT_MASK:
+            raise RuntimeError("Too many channels.")
+        self.streams_by_id.append(channel)
+        return cid
+
+    def _remove_channel(self, channel: Channel) -> NoReturn:
+        """
+        Unregisters the given channel and frees its id.
+
+        Must only be called once per channel.
+        """
+        assert not channel._removed
+
+        channel._removed = True
+        del self.streams[channel.name]
+        if channel.id is not None:
+            self.streams_by_id[channel.id & _ID_SLOT_MASK] = None
+            self._free_ids.append(channel.id)
 
     def connect(self, name: str) -> Channel:
-        c = Channel(self, name)
+        # Channel names are few and long-lived, so interning them is cheap.
+        # Inbound targets are chosen by the peer and are deliberately not interned.
+        c = Channel(self, intern(name))
         register(self, c)
         return c
 
+    async def _begin_write(self) -> NoReturn:
+        """
+        Takes ownership of the parent connection.
+
+        The uncontended case only flips a flag. A future is only created
+        when another writer currently owns the connection.
+        """
+        if not self._writing and not self._waiters:
+            self._writing = True
+            return
+
+        fut = get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except CancelledError:
+            if fut.done() and not fut.cancelled():
+                # We have been handed ownership while being cancelled.
+                self._wake_next()
+            elif fut in self._waiters:
+                self._waiters.remove(fut)
+            raise
+
+    def _wake_next(self) -> NoReturn:
+        """
+        Passes the ownership of the parent connection to the next waiter.
+        """
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self._writing = False
+
+    async def _drain(self) -> NoReturn:
+        # Pick up everything that has been queued since the last run
+        # so the connection is only taken once per batch.
+        event = self._out_event
+        while True:
+            await event.wait()
+            event.clear()
+
+            while self._out_pending:
+                batch, self._out_pending = self._out_pending, []
+                self._wake_blocked(EGRESS_QUEUE_SIZE)
+
+                self._out_busy = True
+                try:
+                    await self._begin_write()
+                    try:
+                        for message in batch:
+                            await self.parent.write(message)
+                    finally:
+                        self._wake_next()
+                except CancelledError:
+                    raise
+                except Exception as e:
+                    # Writers do not wait for their messages. Keep the first error
+                    # and report it on the next write or close. The traceback is
+                    # dropped so nobody can reach the frame of the drainer.
+                    if self._out_error is None:
+                        self._out_error = e.with_traceback(None)
+                finally:
+                    self._out_busy = False
+
+            flushed = self._out_flushed
+            if flushed is not None and not flushed.done():
+                flushed.set_result(None)
+
+    def _wake_blocked(self, count: int) -> NoReturn:
+        blocked = self._out_blocked
+        while blocked and count > 0:
+            fut = blocked.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                count -= 1
+
+    def _raise_write_error(self) -> NoReturn:
+        error, self._out_error = self._out_error, None
+        raise ConnectionError("Failed to write to the parent connection.") from error
+
     async def write(self, message: Message):
-        await self.ensure_acquired()
-        async with self._w_lock:
-            await self.parent.write(message)
+        # The writer only runs while the multiplexer is acquired.
+        _check_acquired_fast(self)
+        if self._out_error is not None:
+            self._raise_write_error()
+
+        # Writers only wait when the peer does not keep up.
+        # They are woken up in order as soon as the drainer picked up the queue.
+        if self._out_blocked or len(self._out_pending) >= EGRESS_QUEUE_SIZE:
+            fut = get_running_loop().create_future()
+            self._out_blocked.append(fut)
+            try:
+                await fut
+            except CancelledError:
+                if fut.done() and not fut.cancelled():
+                    # Pass the free slot on.
+                    self._wake_blocked(1)
+                elif fut in self._out_blocked:
+                    self._out_blocked.remove(fut)
+                raise
+
+            if not self._acquired:
+                raise ConnectionResetError
+
+        self._out_pending.append(message)
+        if not self._out_event.is_set():
+            self._out_event.set()
+
+    async def _flush(self) -> NoReturn:
+        """
+        Waits until everything written before has been passed to the parent.
+        """
+        if not self._out_pending and not self._out_busy:
+            return
+
+        # Concurrent flushes share one future.
+        if self._out_flushed is None or self._out_flushed.done():
+            self._out_flushed = get_running_loop().create_future()
+        await self._out_flushed
 
     async def close(self):
-        await self.ensure_acquired()
-        async with self._w_lock:
+        _check_acquired_fast(self)
+        # Everything written before must reach the parent first.
+        await self._flush()
+        if self._out_error is not None:
+            self._raise_write_error()
+
+        await self._begin_write()
+        try:
             await self.parent.close()
-            self._closed.set()
+            if not self._closed_fut.done():
+                self._closed_fut.set_result(None)
+        finally:
+            self._wake_next()
 
     async def _acquire(self):
+        # The resource manager flags the multiplexer as acquired before calling this.
+        self._acquired = True
+        on_release(self, _mark_released)
+
+        loop = get_running_loop()
+        self._closed_fut = loop.create_future()
+        self._shutdown_fut = loop.create_future()
+
         await self.parent.acquire()
-        _task = ReaderTask(self.parent.input, self._delivered)
+        self._writer_task = loop.create_task(self._drain())
+        self._dispatch_task = loop.create_task(self._dispatch_loop())
+
+        _task = ReaderTask(self.parent.input, self._enqueue)
 
         register(self, _task)
         await _task.acquire()
@@ -207,4 +610,21 @@ class Multiplexer(Resource):
         register(self.parent, self)
 
     async def _release(self):
+        if self._dispatch_task is not None and not self._dispatch_task.done():
+            self._dispatch_task.cancel()
+            await suppress_cancel(self._dispatch_task)
+        self._ingress_ring.clear()
+
+        # Do not wait for a stalled peer here.
+        # Pending messages are dropped and waiting writers are woken up.
+        if self._writer_task is not None and not self._writer_task.done():
+            self._writer_task.cancel()
+            await suppress_cancel(self._writer_task)
+
+        if self._out_flushed is not None and not self._out_flushed.done():
+            self._out_flushed.set_exception(ConnectionResetError())
+        self._out_flushed = None
+        self._out_pending.clear()
+        self._wake_blocked(len(self._out_blocked))
+        self._pipe_pool.clear()
         await self.parent.release(force=False)
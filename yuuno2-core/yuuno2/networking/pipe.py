@@ -16,8 +16,9 @@
 #
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-from asyncio import Queue, Event, ALL_COMPLETED, wait, ensure_future
-from typing import NoReturn, Optional, Tuple, Awaitable
+from asyncio import Queue, Event, ALL_COMPLETED, wait, ensure_future, get_running_loop, TimerHandle
+from collections import deque
+from typing import NoReturn, Optional, Tuple, Awaitable, Deque
 
 from yuuno2.asyncutils import dynamic_timeout
 from yuuno2.networking.base import MessageInputStream, Message, MessageOutputStream, Connection
@@ -26,9 +27,9 @@ from yuuno2.resource_manager import Resource, register
 
 class PipeData(Resource):
 
-    def __init__(self):
+    def __init__(self, queue: Optional[Queue] = None):
         self._tasks = set()
-        self.queue = Queue()
+        self.queue = Queue() if queue is None else queue
         self.closed = Event()
 
     def next_message(self) -> Awaitable[Optional[Message]]:
@@ -37,6 +38,20 @@ class PipeData(Resource):
         task.add_done_callback(lambda f: self._tasks.remove(task))
         return task
 
+    def recycle(self) -> Optional[Queue]:
+        """
+        Detaches the queue from a released pipe so it can back a new pipe.
+
+        :return: The emptied queue or None if the pipe is still in use.
+        """
+        if not self.resource_state.released or self.queue is None:
+            return None
+
+        queue, self.queue = self.queue, None
+        while not queue.empty():
+            queue.get_nowait()
+        return queue
+
     async def _acquire(self) -> NoReturn:
         pass
 
@@ -99,14 +114,65 @@ class PipeOutputStream(MessageOutputStream):
         self.pipe = None
 
 
-def pipe() -> Tuple[PipeInputStream, PipeOutputStream]:
-    data = PipeData()
+def pipe(queue: Optional[Queue] = None) -> Tuple[PipeInputStream, PipeOutputStream]:
+    data = PipeData(queue)
     return (
         PipeInputStream(data),
         PipeOutputStream(data)
     )
 
 
+class PipePool(object):
+    """
+    Keeps the queues of released pipes around so short-lived pipes
+    do not have to allocate new ones.
+
+    Queues that have not been reused for `expiry` seconds are dropped.
+    """
+
+    def __init__(self, maxsize: int = 64, expiry: float = 30.0):
+        self.expiry = expiry
+        self._queues: Deque[Tuple[float, Queue]] = deque(maxlen=maxsize)
+        self._sweeper: Optional[TimerHandle] = None
+
+    def pipe(self) -> Tuple[PipeInputStream, PipeOutputStream]:
+        if self._queues:
+            _, queue = self._queues.pop()
+        else:
+            queue = None
+        return pipe(queue)
+
+    def recycle(self, data: PipeData) -> NoReturn:
+        queue = data.recycle()
+        if queue is None:
+            return
+
+        loop = get_running_loop()
+        self._queues.append((loop.time(), queue))
+        if self._sweeper is None:
+            self._sweeper = loop.call_later(self.expiry, self._sweep)
+
+    def _sweep(self) -> NoReturn:
+        self._sweeper = None
+
+        loop = get_running_loop()
+        deadline = loop.time() - self.expiry
+        while self._queues and self._queues[0][0] <= deadline:
+            self._queues.popleft()
+
+        if self._queues:
+            self._sweeper = loop.call_at(self._queues[0][0] + self.expiry, self._sweep)
+
+    def clear(self) -> NoReturn:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        self._queues.clear()
+
+    def __len__(self):
+        return len(self._queues)
+
+
 def pipe_bidi() -> Tuple[Connection, Connection]:
     p1 = PipeData()
     p2 = PipeData()
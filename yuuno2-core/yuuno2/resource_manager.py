@@ -29,6 +29,7 @@ from weakref import WeakKeyDictionary
 
 
 class Resource(ABC):
+    __slots__ = ('__resource_dict_ref', '__weakref__')
 
     @property
     def acquired(self) -> bool:
@@ -16,13 +16,36 @@
 #
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-from asyncio import wait_for
+from asyncio import wait_for, ensure_future, sleep, Event, gather, get_running_loop
 
 from aiounittest import AsyncTestCase
 
-from yuuno2.networking.base import Message
-from yuuno2.networking.multiplex import Multiplexer
-from yuuno2.networking.pipe import pipe_bidi
+from yuuno2.networking.base import Message, MessageOutputStream, Connection
+from yuuno2.networking.multiplex import Multiplexer, INGRESS_RING_SIZE, REPLY_CACHE_SIZE, EGRESS_QUEUE_SIZE
+from yuuno2.networking.pipe import pipe_bidi, pipe
+
+
+class StalledOutputStream(MessageOutputStream):
+
+    def __init__(self, error: type = None):
+        self.gate = Event()
+        self.error = error
+        self.written = []
+
+    async def write(self, message: Message):
+        if self.error is not None:
+            raise self.error("broken")
+        await self.gate.wait()
+        self.written.append(message)
+
+    async def close(self):
+        pass
+
+    async def _acquire(self):
+        pass
+
+    async def _release(self):
+        pass
 
 
 class TestMultiplexer(AsyncTestCase):
@@ -80,6 +103,20 @@ class TestMultiplexer(AsyncTestCase):
         self.assertIn('payload', msg.values)
         self.assertIs(values, msg.values['payload'])
 
+    async def test_multiplexer_send_batched(self):
+        c_faked_networking, c_multiplexed = pipe_bidi()
+        muliplexer = Multiplexer(c_multiplexed)
+        async with c_faked_networking, muliplexer:
+            async with muliplexer.connect('first') as f1, muliplexer.connect('second') as f2:
+                await f1.write(Message({'i': 0}))
+                await f2.write(Message({'i': 1}))
+                await f1.write(Message({'i': 2}))
+
+                msgs = [(await wait_for(c_faked_networking.read(), 5)) for _ in range(3)]
+
+        self.assertEqual(['first', 'second', 'first'], [msg.values['target'] for msg in msgs])
+        self.assertEqual([0, 1, 2], [msg.values['payload']['i'] for msg in msgs])
+
     async def test_multiplexer_channel_death(self):
         c_faked_networking, c_multiplexed = pipe_bidi()
         muliplexer = Multiplexer(c_multiplexed)
@@ -133,3 +170,283 @@ class TestMultiplexer(AsyncTestCase):
 
                 await wait_for(m2_ch.read(), 5)
                 self.assertTrue(m2_ch.closed)
+
+    async def test_multiplexer_close_waits_for_writer(self):
+        c_faked_networking, c_multiplexed = pipe_bidi()
+        muliplexer = Multiplexer(c_multiplexed)
+        async with c_faked_networking, muliplexer:
+            await muliplexer._begin_write()
+            self.assertTrue(muliplexer._writing)
+
+            closing = ensure_future(muliplexer.close())
+            await sleep(0)
+            self.assertFalse(closing.done())
+
+            muliplexer._wake_next()
+            await wait_for(closing, 5)
+            self.assertFalse(muliplexer._writing)
+
+    async def test_multiplexer_no_channel_ids(self):
+        c_faked_networking, c_multiplexed = pipe_bidi()
+        muliplexer = Multiplexer(c_multiplexed)
+        async with c_faked_networking, muliplexer:
+            async with muliplexer.connect('channel') as f:
+                await f.write(Message({}))
+                msg: Message = await wait_for(c_faked_networking.read(), 5)
+
+        self.assertEqual({'target': 'channel', 'type': 'message', 'payload': {}}, msg.values)
+
+    async def test_multiplexer_channel_ids(self):
+        c_faked_networking, c_multiplexed = pipe_bidi()
+        muliplexer = Multiplexer(c_multiplexed, channel_ids=True)
+        async with c_faked_networking, muliplexer:
+            async with muliplexer.connect('channel') as f:
+                self.assertIs(f, muliplexer.streams_by_id[f.id])
+
+                # Until the peer announced its id, the name is used.
+                await f.write(Message({}))
+                msg: Message = await wait_for(c_faked_networking.read(), 5)
+                self.assertEqual({'target': 'channel', 'sid': f.id, 'type': 'message', 'payload': {}}, msg.values)
+
+                await c_faked_networking.write(Message({'target': 'channel', 'sid': 7, 'payload': {'v': 1}}))
+                msg = await wait_for(f.read(), 5)
+                self.assertEqual(1, msg.values['v'])
+                self.assertEqual(7, f.remote_id)
+
+                # Afterwards both sides use the ids only.
+                await f.write(Message({}))
+                msg = await wait_for(c_faked_networking.read(), 5)
+                self.assertEqual({'sid': f.id, 'tid': 7, 'type': 'message', 'payload': {}}, msg.values)
+
+                await c_faked_networking.write(Message({'sid': 7, 'tid': f.id, 'payload': {'v': 2}}))
+                msg = await wait_for(f.read(), 5)
+                self.assertEqual(2, msg.values['v'])
+
+            msg = await wait_for(c_faked_networking.read(), 5)
+            self.assertEqual({'sid': f.id, 'tid': 7, 'type': 'close'}, msg.values)
+
+    async def test_multiplexer_stale_channel_id(self):
+        c_faked_networking, c_multiplexed = pipe_bidi()
+        muliplexer = Multiplexer(c_multiplexed, channel_ids=True)
+        async with c_faked_networking, muliplexer:
+            async with muliplexer.connect('old') as old:
+                stale = old.id
+
+            async with muliplexer.connect('new') as new:
+                # The slot is reused, the id is not.
+                self.assertIs(new, muliplexer.streams_by_id[stale])
+                self.assertNotEqual(stale, new.id)
+
+                await c_faked_networking.write(Message({'sid': 7, 'tid': stale, 'payload': {}}))
+                msg: Message = await wait_for(c_faked_networking.read(), 5)
+                while msg.values.get('target') == 'old':
+                    msg = await wait_for(c_faked_networking.read(), 5)
+
+        self.assertEqual({'tid': 7, 'type': 'close', 'payload': {}}, msg.values)
+
+    async def test_bidi_multiplexer_mixed_channel_ids(self):
+        c_m1, c_m2 = pipe_bidi()
+        m1 = Multiplexer(c_m1, channel_ids=True)
+        m2 = Multiplexer(c_m2)
+
+        async with m1, m2:
+            async with m1.connect('channel') as m1_ch, m2.connect('channel') as m2_ch:
+                for i in range(2):
+                    await m1_ch.write(Message({'v': i}))
+                    self.assertEqual(i, (await wait_for(m2_ch.read(), 5)).values['v'])
+                    await m2_ch.write(Message({'v': i}))
+                    self.assertEqual(i, (await wait_for(m1_ch.read(), 5)).values['v'])
+
+                # The peer never announced an id, so the name is kept.
+                self.assertIsNone(m1_ch.remote_id)
+
+    async def test_multiplexer_reconnect_after_remote_close(self):
+        c_faked_networking, c_multiplexed = pipe_bidi()
+        muliplexer = Multiplexer(c_multiplexed)
+        async with c_faked_networking, muliplexer:
+            old = muliplexer.connect('channel')
+            async with old:
+                await c_faked_networking.write(Message({'target': 'channel', 'type': 'close'}))
+                self.assertIsNone(await wait_for(old.read(), 5))
+                self.assertNotIn('channel', muliplexer.streams)
+
+                async with muliplexer.connect('channel') as new:
+                    await old.release()
+                    self.assertIs(new, muliplexer.streams['channel'])
+
+    async def test_multiplexer_reconnect_after_local_close(self):
+        c_faked_networking, c_multiplexed = pipe_bidi()
+        muliplexer = Multiplexer(c_multiplexed)
+        async with c_faked_networking, muliplexer:
+            old = muliplexer.connect('channel')
+            async with old:
+                await old.close()
+                self.assertNotIn('channel', muliplexer.streams)
+
+                msg: Message = await wait_for(c_faked_networking.read(), 5)
+                self.assertEqual('close', msg.values['type'])
+
+                # Messages still in flight are rejected as the channel is gone.
+                await c_faked_networking.write(Message({'target': 'channel', 'payload': {}}))
+                msg: Message = await wait_for(c_faked_networking.read(), 5)
+                self.assertEqual('channel', msg.values['target'])
+                self.assertEqual('close', msg.values['type'])
+
+                async with muliplexer.connect('channel') as new:
+                    await old.release()
+                    self.assertIs(new, muliplexer.streams['channel'])
+
+    async def test_multiplexer_connect_duplicate(self):
+        c_faked_networking, c_multiplexed = pipe_bidi()
+        muliplexer = Multiplexer(c_multiplexed)
+        async with c_faked_networking, muliplexer:
+            async with muliplexer.connect('channel') as existing:
+                duplicate = muliplexer.connect('channel')
+                await duplicate.acquire()
+                self.assertFalse(duplicate.acquired)
+                self.assertIs(existing, muliplexer.streams['channel'])
+
+    async def test_multiplexer_deliver_burst(self):
+        count = INGRESS_RING_SIZE * 2
+
+        c_faked_networking, c_multiplexed = pipe_bidi()
+        muliplexer = Multiplexer(c_multiplexed)
+        async with c_faked_networking, muliplexer:
+            async with muliplexer.connect('existing') as f:
+                for i in range(count):
+                    await c_faked_networking.write(Message({'target': 'existing', 'type': 'message', 'payload': {'i': i}}))
+
+                msgs = [(await wait_for(f.read(), 5)) for _ in range(count)]
+
+        self.assertEqual(list(range(count)), [msg.values['i'] for msg in msgs])
+
+    async def test_multiplexer_dispatch_error(self):
+        errors = []
+        loop = get_running_loop()
+        loop.set_exception_handler(lambda _, context: errors.append(context['exception']))
+
+        c_faked_networking, c_multiplexed = pipe_bidi()
+        muliplexer = Multiplexer(c_multiplexed)
+        try:
+            async with c_faked_networking, muliplexer:
+                async with muliplexer.connect('existing') as f:
+                    await c_faked_networking.write(Message(['not', 'an', 'object']))
+                    await c_faked_networking.write(Message({'target': 'existing', 'payload': {'v': 1}}))
+                    msg: Message = await wait_for(f.read(), 5)
+        finally:
+            loop.set_exception_handler(None)
+
+        self.assertEqual(1, msg.values['v'])
+        self.assertEqual(1, len(errors))
+        self.assertIsInstance(errors[0], TypeError)
+
+    async def test_multiplexer_unknown_type(self):
+        c_faked_networking, c_multiplexed = pipe_bidi()
+        muliplexer = Multiplexer(c_multiplexed)
+        async with c_faked_networking, muliplexer:
+            async with muliplexer.connect('existing'):
+                await c_faked_networking.write(Message({'target': 'existing', 'type': 'unknown', 'payload': {}}))
+                msg: Message = await wait_for(c_faked_networking.read(), 5)
+
+        self.assertEqual('existing', msg.values['target'])
+        self.assertEqual('illegal', msg.values['type'])
+
+    async def test_multiplexer_unhashable_type(self):
+        c_faked_networking, c_multiplexed = pipe_bidi()
+        muliplexer = Multiplexer(c_multiplexed)
+        async with c_faked_networking, muliplexer:
+            async with muliplexer.connect('existing'):
+                await c_faked_networking.write(Message({'target': 'existing', 'type': ['message'], 'payload': {}}))
+                msg: Message = await wait_for(c_faked_networking.read(), 5)
+
+        self.assertEqual('existing', msg.values['target'])
+        self.assertEqual('illegal', msg.values['type'])
+
+    async def test_multiplexer_reply_cache(self):
+        c_faked_networking, c_multiplexed = pipe_bidi()
+        muliplexer = Multiplexer(c_multiplexed)
+        async with c_faked_networking, muliplexer:
+            self.assertIs(muliplexer._reply('a', 'close'), muliplexer._reply('a', 'close'))
+            self.assertIsNot(muliplexer._reply('a', 'close'), muliplexer._reply('a', 'illegal'))
+
+            for i in range(REPLY_CACHE_SIZE + 1):
+                muliplexer._reply(str(i), 'close')
+            self.assertEqual(REPLY_CACHE_SIZE, len(muliplexer._reply_cache))
+            self.assertNotIn(('a', 'close'), muliplexer._reply_cache)
+
+    async def test_multiplexer_acquired_flag(self):
+        c_faked_networking, c_multiplexed = pipe_bidi()
+        muliplexer = Multiplexer(c_multiplexed)
+        channel = muliplexer.connect('channel')
+        async with c_faked_networking:
+            async with muliplexer:
+                async with channel:
+                    self.assertTrue(muliplexer._acquired)
+                    self.assertTrue(channel._acquired)
+                self.assertFalse(channel._acquired)
+            self.assertFalse(muliplexer._acquired)
+
+    async def test_multiplexer_write_not_acquired(self):
+        c_faked_networking, c_multiplexed = pipe_bidi()
+        muliplexer = Multiplexer(c_multiplexed)
+        with self.assertRaises(AssertionError):
+            await muliplexer.write(Message({}))
+
+    async def test_multiplexer_write_backpressure(self):
+        pipe_r, _ = pipe()
+        output = StalledOutputStream()
+        muliplexer = Multiplexer(Connection(pipe_r, output))
+        async with muliplexer:
+            async with muliplexer.connect('channel') as f:
+                writes = [ensure_future(f.write(Message({'i': i}))) for i in range(EGRESS_QUEUE_SIZE * 3)]
+                await sleep(0.1)
+
+                # One batch is stuck in the parent, one batch is queued. The rest has to wait.
+                self.assertEqual(EGRESS_QUEUE_SIZE, sum(not w.done() for w in writes))
+                self.assertLessEqual(len(muliplexer._out_pending), EGRESS_QUEUE_SIZE)
+
+                output.gate.set()
+                await wait_for(gather(*writes), 5)
+                await wait_for(muliplexer._flush(), 5)
+
+        self.assertEqual(
+            list(range(EGRESS_QUEUE_SIZE * 3)),
+            [msg.values['payload']['i'] for msg in output.written if msg.values['type'] == 'message']
+        )
+
+    async def test_multiplexer_write_error(self):
+        pipe_r, _ = pipe()
+        muliplexer = Multiplexer(Connection(pipe_r, StalledOutputStream(error=ValueError)))
+        async with muliplexer:
+            await muliplexer.write(Message({}))
+            await wait_for(muliplexer._flush(), 5)
+
+            with self.assertRaises(ConnectionError) as cm:
+                await wait_for(muliplexer.write(Message({})), 5)
+            self.assertIsInstance(cm.exception.__cause__, ValueError)
+
+            # The writer keeps running after an error.
+            self.assertFalse(muliplexer._writer_task.done())
+            await wait_for(muliplexer.write(Message({})), 5)
+            await wait_for(muliplexer._flush(), 5)
+
+            with self.assertRaises(ConnectionError):
+                await wait_for(muliplexer.close(), 5)
+
+    async def test_multiplexer_release_stalled(self):
+        pipe_r, _ = pipe()
+        muliplexer = Multiplexer(Connection(pipe_r, StalledOutputStream()))
+        await muliplexer.acquire()
+
+        # The first message stalls the parent, the rest fill the queue.
+        await muliplexer.write(Message({}))
+        await sleep(0)
+        for _ in range(EGRESS_QUEUE_SIZE):
+            await muliplexer.write(Message({}))
+        pending = ensure_future(muliplexer.write(Message({})))
+        await sleep(0)
+        self.assertFalse(pending.done())
+
+        await wait_for(muliplexer.release(), 1)
+        with self.assertRaises(ConnectionResetError):
+            await wait_for(pending, 1)
@@ -23,7 +23,7 @@ from asyncio import sleep, TimeoutError
 from aiounittest import AsyncTestCase
 
 from yuuno2.networking.base import Message, Connection
-from yuuno2.networking.pipe import pipe
+from yuuno2.networking.pipe import pipe, PipePool
 
 
 class TestPipeNetworking(AsyncTestCase):
@@ -81,4 +81,44 @@ class TestPipeNetworking(AsyncTestCase):
             task = get_running_loop().create_task(_concurrent())
             await sleep(1.2)
             await pc.close()
-            await task
\ No newline at end of file
+            await task
+
+
+class TestPipePool(AsyncTestCase):
+
+    async def test_pool_reuses_queue(self):
+        pool = PipePool()
+        pipe_r, pipe_w = pool.pipe()
+        data = pipe_r.pipe
+        queue = data.queue
+
+        async with Connection(pipe_r, pipe_w) as pc:
+            await pc.write(Message({}, []))
+
+        pool.recycle(data)
+        self.assertEqual(1, len(pool))
+        self.assertTrue(queue.empty())
+
+        pipe_r, pipe_w = pool.pipe()
+        self.assertIs(queue, pipe_r.pipe.queue)
+        self.assertEqual(0, len(pool))
+        pool.clear()
+
+    async def test_pool_ignores_active_pipe(self):
+        pool = PipePool()
+        pipe_r, pipe_w = pool.pipe()
+        async with Connection(pipe_r, pipe_w):
+            pool.recycle(pipe_r.pipe)
+            self.assertEqual(0, len(pool))
+
+    async def test_pool_expires_queues(self):
+        pool = PipePool(expiry=0.1)
+        pipe_r, pipe_w = pool.pipe()
+        data = pipe_r.pipe
+        async with Connection(pipe_r, pipe_w):
+            pass
+
+        pool.recycle(data)
+        self.assertEqual(1, len(pool))
+        await sleep(0.3)
+        self.assertEqual(0, len(pool))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Yuuno - IPython + VapourSynth
+# Copyright (C) 2019 StuxCrystal (Roland Netzsch <stuxcrystal@encode.moe>)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import sys
+import types
+import importlib
+from unittest import mock
+
+from aiounittest import AsyncTestCase
+
+from yuuno2.tests.mocks import MockResource
+
+
+class FakeEnvironment(object):
+
+    def __init__(self):
+        self.entered = 0
+        self.exited = 0
+        self.alive = True
+
+    def __enter__(self):
+        self.entered += 1
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.exited += 1
+
+
+def _fake_vapoursynth() -> types.ModuleType:
+    vs = types.ModuleType("vapoursynth")
+    vs.__pyx_capi__ = {}
+    vs.Environment = FakeEnvironment
+    vs.vpy_current_environment = FakeEnvironment
+    vs.get_outputs = lambda: {}
+    vs.get_core = lambda: None
+    vs.core = None
+    for name in ("Core", "VideoFrame", "VideoNode", "Format", "AlphaOutputTuple"):
+        setattr(vs, name, type(name, (object,), {}))
+    return vs
+
+
+class TestVapourSynthScript(AsyncTestCase):
+
+    def setUp(self):
+        # Use the real module if it is installed.
+        try:
+            importlib.import_module("vapoursynth")
+        except ImportError:
+            modules = {"vapoursynth": _fake_vapoursynth()}
+        else:
+            modules = {}
+
+        # Drops the modules imported in the test again.
+        self._modules = mock.patch.dict(sys.modules, modules)
+        self._modules.start()
+
+    def tearDown(self):
+        self._modules.stop()
+
+    async def test_vsscript_construct(self):
+        from yuuno2.vapoursynth.vsscript.script import VSScript
+
+        script = VSScript(MockResource("provider"))
+        self.assertIsNone(script.environment)
+
+    async def test_inside_uses_current_environment(self):
+        from yuuno2.vapoursynth.script import VapourSynthScript
+
+        first = FakeEnvironment()
+        script = VapourSynthScript(first)
+        with script.inside():
+            pass
+
+        second = FakeEnvironment()
+        script.environment = second
+        with script.inside():
+            pass
+
+        self.assertEqual((1, 1), (first.entered, first.exited))
+        self.assertEqual((1, 1), (second.entered, second.exited))
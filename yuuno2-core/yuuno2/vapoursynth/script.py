@@ -29,6 +29,25 @@ from yuuno2.typings import ConfigTypes
 from yuuno2.vapoursynth.clip import VapourSynthClip
 
 
+class _EnvironmentGuard(object):
+    """
+    Context manager that enters the current environment of the script.
+
+    A slotted object is a lot cheaper to create and enter than the
+    generator based context manager of Script.inside().
+    """
+    __slots__ = ('script',)
+
+    def __init__(self, script: 'VapourSynthScript'):
+        self.script = script
+
+    def __enter__(self) -> NoReturn:
+        self.script.environment.__enter__()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> NoReturn:
+        self.script.environment.__exit__(None, None, None)
+
+
 class VapourSynthScript(Script):
 
     def __init__(self, environment: Environment):
@@ -42,6 +61,9 @@ class VapourSynthScript(Script):
     def deactivate(self) -> NoReturn:
         self.environment.__exit__(None, None, None)
 
+    def inside(self) -> _EnvironmentGuard:
+        return _EnvironmentGuard(self)
+
     async def set_config(self, key: str, value: ConfigTypes) -> NoReturn:
         await self.ensure_acquired()
         self.config[key] = value
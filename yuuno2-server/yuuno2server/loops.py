@@ -1,4 +1,11 @@
-from asyncio import set_event_loop
+import sys
+import warnings
+from asyncio import set_event_loop, set_event_loop_policy
+
+
+def _supports_uring() -> bool:
+    # io_uring is only available on Linux.
+    return sys.platform.startswith("linux")
 
 
 def install_event_loop(event_loop):
@@ -6,6 +13,16 @@ def install_event_loop(event_loop):
         import uvloop
 
         uvloop.install()
+    elif event_loop == "uring":
+        if _supports_uring():
+            import uringcore
+            set_event_loop_policy(uringcore.EventLoopPolicy())
+        else:
+            warnings.warn(
+                "The uring event-loop is only available on Linux. Using the default event-loop instead.",
+                RuntimeWarning,
+                stacklevel=2
+            )
     elif event_loop == "iocp":
         from asyncio import ProactorEventLoop
         set_event_loop(ProactorEventLoop())
@@ -116,7 +116,7 @@ if __name__ == "__main__":
 
     @click.command()
     @click.option("--provider", help="Which script-provider should provide the script?", prompt=False)
-    @click.option("--event-loop", default="default", help="The AsyncIO Event-Loop to be used.")
+    @click.option("--event-loop", default="default", help="The AsyncIO Event-Loop to be used. (default, uvloop, iocp, uring)")
     def main(provider, event_loop):
         print("Initializing subprocess...", file=sys.stderr)
         module, variable = provider.split(":")
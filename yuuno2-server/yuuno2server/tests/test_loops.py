@@ -0,0 +1,33 @@
+import sys
+from types import ModuleType
+from unittest import TestCase, mock
+
+from yuuno2server import loops
+
+
+class TestInstallEventLoop(TestCase):
+
+    def _uringcore(self):
+        uringcore = ModuleType("uringcore")
+        uringcore.EventLoopPolicy = mock.Mock(name="EventLoopPolicy")
+        return uringcore
+
+    def test_uring(self):
+        uringcore = self._uringcore()
+        with mock.patch.dict(sys.modules, {"uringcore": uringcore}), \
+                mock.patch.object(loops, "_supports_uring", return_value=True), \
+                mock.patch.object(loops, "set_event_loop_policy") as set_policy:
+            loops.install_event_loop("uring")
+
+        set_policy.assert_called_once_with(uringcore.EventLoopPolicy.return_value)
+
+    def test_uring_not_linux(self):
+        uringcore = self._uringcore()
+        with mock.patch.dict(sys.modules, {"uringcore": uringcore}), \
+                mock.patch.object(loops, "_supports_uring", return_value=False), \
+                mock.patch.object(loops, "set_event_loop_policy") as set_policy:
+            with self.assertWarns(RuntimeWarning):
+                loops.install_event_loop("uring")
+
+        set_policy.assert_not_called()
+        uringcore.EventLoopPolicy.assert_not_called()